@@ -1,17 +1,27 @@
 #!/usr/bin/env python
 
 import argparse
+import os
 import pathlib
 import sys
-import xml.etree.ElementTree as ET
 import zipfile
 
-from collections import defaultdict
 from enum import Enum, auto
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+else:
+    # scratch buffer for needs_gromemul, one max-sized extra region
+    gromemul_buf = np.empty(2048, dtype=np.uint8)
+
 paged_pcbs = {'7': "paged7", '12k': "paged12k", '16k': "paged",
               '377': "paged377", '378': "paged378", '379i': "paged379i"}
 
+hint_pcbs = {'3': "paged379i", '9': "paged379i",
+             '7': "paged377", '8': "paged378"}
+
 
 class BinfileType(Enum):
     C = auto()
@@ -19,23 +29,27 @@ class BinfileType(Enum):
     G = auto()
 
 
+def strip_bin_suffix(fn):
+    stem, ext = os.path.splitext(fn)
+    if ext.lower() == ".bin":
+        return stem
+    else:
+        return fn
+
+
 def get_bankinghint(fn):
-    fn = fn.lower()
-    if fn.endswith(".bin"):
-        fn = fn[:-4]
+    fn = strip_bin_suffix(fn)
     if len(fn) > 0:
-        return fn[-1]
+        return fn[-1].lower()
     else:
         return None
 
 
 def binfile_type_from_name(fn):
-    fn = fn.lower()
-    if fn.endswith(".bin"):
-        fn = fn[:-4]
-    if fn.endswith("g"):
+    c = strip_bin_suffix(fn)[-1:].lower()
+    if c == "g":
         return BinfileType.G
-    elif fn.endswith("d"):
+    elif c == "d":
         return BinfileType.D
     else:
         return BinfileType.C
@@ -44,7 +58,7 @@ def binfile_type_from_name(fn):
 def binfile_name_change_to_type(fn, target):
     if binfile_type_from_name(fn) == target:
         return fn
-    if fn.lower().endswith(".bin"):
+    if fn[-4:].lower() == ".bin":
         p = -5
     else:
         p = -1
@@ -55,9 +69,10 @@ def binfile_name_change_to_type(fn, target):
     if c == fn[p]:
         rep = rep.lower()
     if c == 'g' or c == 'c' or c == 'd':
-        fn = list(fn)
-        fn[p] = rep
-        return "".join(fn)
+        if p == -1:
+            return fn[:-1] + rep
+        else:
+            return fn[:-5] + rep + fn[-4:]
     else:
         return None
 
@@ -65,34 +80,154 @@ def binfile_name_change_to_type(fn, target):
 def needs_gromemul(data):
     if data is None:
         return False
+    if np is not None:
+        arr = np.frombuffer(data, dtype=np.uint8)
+        for b in range(0, arr.size, 8192):
+            slice = arr[b:b+8192]
+            if slice.size > 6144:
+                extra = slice[6144:]
+                if not np.any(extra):
+                    continue
+                garbage = gromemul_buf[:extra.size]
+                np.bitwise_or(slice[0x800:0x800+extra.size],
+                              slice[0x1000:0x1000+extra.size], out=garbage)
+                if not np.array_equal(extra, garbage):
+                    return True
+        return False
     for b in range(0, len(data), 8192):
         slice = data[b:b+8192]
         if len(slice) > 6144:
             extra = slice[6144:]
-            garbage = bytearray(len(extra))
-            for o in range(0, len(extra)):
-                garbage[o] = slice[o+0x800] | slice[o+0x1000]
-            if (extra.count(b'\0') < len(extra) and extra != garbage):
+            if extra.count(b'\0') == len(extra):
+                continue
+            n = len(extra)
+            garbage = (int.from_bytes(slice[0x800:0x800+n], 'little')
+                       | int.from_bytes(slice[0x1000:0x1000+n], 'little')
+                       ).to_bytes(n, 'little')
+            if extra != garbage:
                 return True
     return False
 
 
+def fast_read(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return os.read(fd, size)
+    finally:
+        os.close(fd)
+
+
+def looks_like_zip(path):
+    with open(path, 'rb') as f:
+        return f.read(4) == b'PK\x03\x04'
+
+
 def find_main_file_in_zip(zip):
-    bins = defaultdict(list)
+    g_first = c_first = None
+    g_count = c_count = 0
     for f in zip.namelist():
-        if (f.lower().endswith(".bin")):
-            bins[binfile_type_from_name(f)].append(f)
-    if len(bins[BinfileType.G]) == 1:
-        choice = bins[BinfileType.G].pop()
-    elif len(bins[BinfileType.C]) == 1:
-        choice = bins[BinfileType.C].pop()
+        stem, ext = os.path.splitext(f)
+        if ext.lower() != ".bin":
+            continue
+        type = binfile_type_from_name(stem)
+        if type == BinfileType.G:
+            g_count += 1
+            if g_first is None:
+                g_first = f
+        elif type == BinfileType.C:
+            c_count += 1
+            if c_first is None:
+                c_first = f
+        if g_count > 1 and c_count > 1:
+            break
+    if g_count == 1:
+        choice = g_first
+    elif c_count == 1:
+        choice = c_first
     else:
         raise RuntimeError("Unable to guess main bin in provided zip")
     return zipfile.Path(zip, at=choice)
 
 
+def validate_standard(cart):
+    if cart.cbin is not None and len(cart.cbin) > 8192:
+        raise RuntimeError("pcbtype standard can not handle ROM "
+                           "larger than 8K")
+
+
+def validate_gromemu(cart):
+    if cart.dbin is not None:
+        if len(cart.cbin) == 8192:
+            cart.cbin = cart.cbin + cart.dbin
+            cart.dbin = None
+        else:
+            raise RuntimeError("Can't use d.bin with pcbtype "
+                               "gromemu unless c.bin is 8K")
+    if cart.cbin is not None and len(cart.cbin) > 33554432:
+        raise RuntimeError("pcbtype gromemu can not handle ROM "
+                           "larger than 32M")
+
+
+def validate_paged7(cart):
+    if len(cart.cbin) > 16384:
+        raise RuntimeError("pcbtype paged7 can not handle ROM "
+                           "larger than 16K")
+
+
+def validate_paged12k(cart):
+    if len(cart.cbin) > 4096:
+        raise RuntimeError("pcbtype paged12k can not handle c.bin "
+                           "larger than 4K")
+    if len(cart.dbin) > 8192:
+        raise RuntimeError("pcbtype paged12k can not handle d.bin "
+                           "larger than 8K")
+
+
+def validate_paged(cart):
+    if len(cart.cbin) > 8192 or len(cart.dbin) > 8192:
+        raise RuntimeError("pcbtype paged can not handle c.bin "
+                           "or d.bin larger than 8K")
+
+
+def validate_paged377(cart):
+    if len(cart.cbin) > 2097152:
+        raise RuntimeError("pcbtype paged377 can not handle ROM "
+                           "larger than 2M")
+
+
+def validate_paged378(cart):
+    if cart.gbin is not None and len(cart.gbin) > 40960:
+        raise RuntimeError(">40K GROM data not currently supported "
+                           "for pcbtype paged378")
+    if len(cart.cbin) > 524288:
+        raise RuntimeError("pcbtype paged378 can not handle ROM "
+                           "larger than 512K")
+
+
+def validate_paged379i(cart):
+    if len(cart.cbin) > 131072:
+        raise RuntimeError("pcbtype paged379i can not handle ROM "
+                           "larger than 128K")
+
+
+pcb_validators = {'standard': validate_standard,
+                  'gromemu': validate_gromemu,
+                  'paged7': validate_paged7,
+                  'paged12k': validate_paged12k,
+                  'paged': validate_paged,
+                  'paged377': validate_paged377,
+                  'paged378': validate_paged378,
+                  'paged379i': validate_paged379i}
+
+
 class Cartridge:
 
+    __slots__ = ('pcbtype', 'cbin', 'dbin', 'gbin', 'mainbin',
+                 'bankinghint', 'cname', 'dname', 'gname')
+
     def __init__(self, path=None):
         self.pcbtype = None
         self.cbin = None
@@ -122,13 +257,24 @@ class Cartridge:
         # elif target == BinfileType.G:
         #     self.gname = path.name
         print("Loading %s" % (path,))
-        return path.read_bytes()
+        if isinstance(path, zipfile.Path):
+            info = path.root.getinfo(path.at)
+            if info.file_size == 0:
+                return b''
+            with path.root.open(info) as f:
+                return f.read(info.file_size)
+        return fast_read(path)
 
     def load(self, path):
-        if not isinstance(path, zipfile.Path) and zipfile.is_zipfile(path):
-            with zipfile.ZipFile(path) as zip:
-                self.load(find_main_file_in_zip(zip))
-            return
+        if not isinstance(path, zipfile.Path) and looks_like_zip(path):
+            try:
+                zip = zipfile.ZipFile(path)
+            except zipfile.BadZipFile:
+                pass
+            else:
+                with zip:
+                    self.load(find_main_file_in_zip(zip))
+                return
         self.cbin = self._load_bin(path, BinfileType.C)
         self.dbin = self._load_bin(path, BinfileType.D)
         self.gbin = self._load_bin(path, BinfileType.G)
@@ -148,6 +294,9 @@ class Cartridge:
             raise RuntimeError("FinalGROM advanced modes not supported")
         if paged is not None:
             self.pcbtype = paged_pcbs[paged]
+            if needs_gromemul(self.gbin) and self.pcbtype != "gromemu":
+                raise RuntimeError("8K/GROM data can not be used with "
+                                   "pcbtype %s" % (self.pcbtype,))
         else:
             if needs_gromemul(self.gbin):
                 print("Selected pcbtype gromemu because of 8K/GROM data")
@@ -167,18 +316,11 @@ class Cartridge:
                       "is needed")
                 self.pcbtype = "standard"
             else:
-                if self.bankinghint == '3' or self.bankinghint == '9':
-                    print("Selected pcbtype paged379i because name "
-                          "ends with a %s" % (self.bankinghint,))
-                    self.pcbtype = "paged379i"
-                elif self.bankinghint == '7':
-                    print("Selected pcbtype paged377 because name "
-                          "ends with a 7")
-                    self.pcbtype = "paged377"
-                elif self.bankinghint == '8':
-                    print("Selected pcbtype paged378 because name "
-                          "ends with a 8")
-                    self.pcbtype = "paged378"
+                hinted = hint_pcbs.get(self.bankinghint)
+                if hinted is not None:
+                    print("Selected pcbtype %s because name "
+                          "ends with a %s" % (hinted, self.bankinghint))
+                    self.pcbtype = hinted
                 elif len(self.cbin) > 524288:
                     print("Selected pcbtype paged377 because c.bin "
                           "is larger than 512K")
@@ -186,9 +328,6 @@ class Cartridge:
                 else:
                     print("Selected pcbtype paged378")
                     self.pcbtype = "paged378"
-        if needs_gromemul(self.gbin) and self.pcbtype != "gromemu":
-            raise RuntimeError("8K/GROM data can not be used with pcbtype %s"
-                               % (self.pcbtype,))
         if (self.gbin is not None and len(self.gbin) > 40960 and
                 self.pcbtype != "paged378"):
             raise RuntimeError(">40K GROM data can not be used with pcbtype %s"
@@ -202,79 +341,51 @@ class Cartridge:
             raise RuntimeError("pcbtype %s requires d.bin" % (self.pcbtype,))
         if self.cbin is None and self.pcbtype.startswith("paged"):
             raise RuntimeError("pcbtype %s requires c.bin" % (self.pcbtype,))
-        if self.pcbtype == "standard":
-            if self.cbin is not None and len(self.cbin) > 8192:
-                raise RuntimeError("pcbtype standard can not handle ROM "
-                                   "larger than 8K")
-        elif self.pcbtype == "gromemu":
-            if self.dbin is not None:
-                if len(self.cbin) == 8192:
-                    self.cbin = self.cbin + self.dbin
-                    self.dbin = None
-                else:
-                    raise RuntimeError("Can't use d.bin with pcbtype "
-                                       "gromemu unless c.bin is 8K")
-            if self.cbin is not None and len(self.cbin) > 33554432:
-                raise RuntimeError("pcbtype gromemu can not handle ROM "
-                                   "larger than 32M")
-        elif self.pcbtype == "paged7":
-            if len(self.cbin) > 16384:
-                raise RuntimeError("pcbtype paged7 can not handle ROM "
-                                   "larger than 16K")
-        elif self.pcbtype == "paged12k":
-            if len(self.cbin) > 4096:
-                raise RuntimeError("pcbtype paged12k can not handle c.bin "
-                                   "larger than 4K")
-            if len(self.dbin) > 8192:
-                raise RuntimeError("pcbtype paged12k can not handle d.bin "
-                                   "larger than 8K")
-        elif self.pcbtype == "paged":
-            if len(self.cbin) > 8192 or len(self.dbin) > 8192:
-                raise RuntimeError("pcbtype paged can not handle c.bin "
-                                   "or d.bin larger than 8K")
-        elif self.pcbtype == "paged377":
-            if len(self.cbin) > 2097152:
-                raise RuntimeError("pcbtype paged377 can not handle ROM "
-                                   "larger than 2M")
-        elif self.pcbtype == "paged378":
-            if self.gbin is not None and len(self.gbin) > 40960:
-                raise RuntimeError(">40K GROM data not currently supported "
-                                   "for pcbtype paged378")
-            if len(self.cbin) > 524288:
-                raise RuntimeError("pcbtype paged378 can not handle ROM "
-                                   "larger than 512K")
-        elif self.pcbtype == "paged379i":
-            if len(self.cbin) > 131072:
-                raise RuntimeError("pcbtype paged379i can not handle ROM "
-                                   "larger than 128K")
-        else:
+        validate = pcb_validators.get(self.pcbtype)
+        if validate is None:
             raise RuntimeError("Unhandled pcbtype %s" % (self.pcbtype,))
+        validate(self)
 
     def write_rpk(self, rpk):
         if self.pcbtype is None:
             self.select_pcb_type()
+        resources = []
+        sockets = []
         if self.gbin is not None:
-            rpk.writestr(self.gname, self.gbin)
-        if self.cbin is not None:
-            rpk.writestr(self.cname, self.cbin)
-        if self.dbin is not None:
-            rpk.writestr(self.dname, self.dbin)
-        romset = ET.Element('romset', {'version': "1.0"})
-        resources = ET.SubElement(romset, 'resources')
-        configuration = ET.SubElement(romset, 'configuration')
-        pcb = ET.SubElement(configuration, 'pcb', type=self.pcbtype)
-        if self.gbin is not None:
-            ET.SubElement(resources, 'rom', id="gromimage", file=self.gname)
-            ET.SubElement(pcb, 'socket', id="grom_socket", uses="gromimage")
+            rpk.writestr(self.gname, self.gbin,
+                         compress_type=zipfile.ZIP_STORED)
+            resources.append('      <rom id="gromimage" file="%s" />'
+                             % (self.gname,))
+            sockets.append('         <socket id="grom_socket" '
+                           'uses="gromimage" />')
         if self.cbin is not None:
-            ET.SubElement(resources, 'rom', id="romimage", file=self.cname)
-            ET.SubElement(pcb, 'socket', id="rom_socket", uses="romimage")
+            rpk.writestr(self.cname, self.cbin,
+                         compress_type=zipfile.ZIP_STORED)
+            resources.append('      <rom id="romimage" file="%s" />'
+                             % (self.cname,))
+            sockets.append('         <socket id="rom_socket" '
+                           'uses="romimage" />')
         if self.dbin is not None:
-            ET.SubElement(resources, 'rom', id="rom2image", file=self.dname)
-            ET.SubElement(pcb, 'socket', id="rom2_socket", uses="rom2image")
-        ET.indent(romset, '   ')
-        layout = ET.tostring(romset, encoding='utf-8', xml_declaration=True)
-        rpk.writestr('layout.xml', layout+b'\n')
+            rpk.writestr(self.dname, self.dbin,
+                         compress_type=zipfile.ZIP_STORED)
+            resources.append('      <rom id="rom2image" file="%s" />'
+                             % (self.dname,))
+            sockets.append('         <socket id="rom2_socket" '
+                           'uses="rom2image" />')
+        layout = "\n".join(
+            ["<?xml version='1.0' encoding='utf-8'?>",
+             '<romset version="1.0">',
+             '   <resources>']
+            + resources
+            + ['   </resources>',
+               '   <configuration>',
+               '      <pcb type="%s">' % (self.pcbtype,)]
+            + sockets
+            + ['      </pcb>',
+               '   </configuration>',
+               '</romset>',
+               ''])
+        rpk.writestr('layout.xml', layout.encode('utf-8'))
 
 
 def main():
@@ -298,8 +409,8 @@ def main():
     cart = Cartridge(args.main_file)
     cart.select_pcb_type(paged=args.paged)
     print("Writing RPK to %s" % (args.output,))
-    with zipfile.ZipFile(args.output, 'x', compression=zipfile.ZIP_DEFLATED,
-                         compresslevel=9) as rpk:
+    with zipfile.ZipFile(args.output, 'x',
+                         compression=zipfile.ZIP_DEFLATED) as rpk:
         cart.write_rpk(rpk)
 
 